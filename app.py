@@ -1,16 +1,35 @@
 
 import os
 import io
+import csv
+import asyncio
+import random
 import json
 import re
+import hashlib
+import importlib
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-from flask import Flask, render_template, request, session, redirect, url_for
+from quart import (
+    Quart, Response, render_template, request, session, redirect, url_for
+)
+from quart_session import Session
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+)
 
-import pandas as pd
-from docx import Document
-from PyPDF2 import PdfReader
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -18,44 +37,233 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is not set in .env")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Retries are handled by llm_call so backoff happens outside the semaphore
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret-change-me")
 
+# Keep session data (rubric text and parsed JSON) in Redis; the cookie only
+# carries the session id
+app.config["SESSION_TYPE"] = "redis"
+app.config["SESSION_URI"] = os.getenv("REDIS_URL", "redis://localhost:6379")
+Session(app)
+
 # Shared teacher access password
 ACCESS_PASSWORD = "teacheraccess"
 
+# Matches one "Score: Y/X" line of a teacher report
+_SCORE_RE = re.compile(r"Score:\s*(\d+)\s*/\s*(\d+)")
+
+# Maximum number of student submissions graded together in one LLM call
+BATCH_SIZE = 4
+
+# Concurrent OpenAI requests per worker, and attempts per call when rate
+# limited (429) or on transient connection/server errors
+MAX_CONCURRENCY = 20
+MAX_RETRIES = 5
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+_llm_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Bounded pool for blocking file parsing, so uploads don't stall the event loop
+FILE_PARSE_WORKERS = 4
+_file_executor = ThreadPoolExecutor(max_workers=FILE_PARSE_WORKERS)
+
+# Input token budgets. Rubrics and submissions are truncated to these limits;
+# submissions above MAX_STUDENT_TOKENS are reviewed in overlapping windows
+# before a final grading call.
+MAX_RUBRIC_TOKENS = 8000
+MAX_STUDENT_TOKENS = 12000
+MAX_SUBMISSION_TOKENS = 48000
+WINDOW_TOKENS = 6000
+WINDOW_OVERLAP_TOKENS = 500
+# Rough size of a token when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+# On-disk cache of LLM results, keyed by content hashes
+JUDGE_CACHE_DIR = Path(".judge_cache")
+
+
+def dump_rubric_json(rubric_json):
+    # Indented rubric JSON for prompts; orjson is much faster when installed.
+    # Both paths must give the same string, because grade cache keys hash it.
+    if orjson is not None:
+        return orjson.dumps(rubric_json, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(rubric_json, indent=2, ensure_ascii=False)
+
+
+def load_json(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+_encodings = {}
+
+
+def _tokenize(text, model):
+    # Returns a sliceable token sequence, its decoder, and the number of
+    # sequence items per token (characters when tiktoken is unavailable)
+    if tiktoken is not None and model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # Encoding files could not be fetched; estimate from characters
+            _encodings[model] = None
+
+    encoding = _encodings.get(model)
+    if encoding is None:
+        return text, str, CHARS_PER_TOKEN
+    return encoding.encode(text, disallowed_special=()), encoding.decode, 1
+
+
+def count_tokens(text, model):
+    tokens, _, scale = _tokenize(text, model)
+    return len(tokens) // scale
+
+
+def split_tokens(text, max_tokens, model, overlap=0):
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+    tokens, decode, scale = _tokenize(text, model)
+    size = max_tokens * scale
+    if len(tokens) <= size:
+        return [text]
+    step = (max_tokens - overlap) * scale
+    return [
+        decode(tokens[start:start + size])
+        for start in range(0, len(tokens) - overlap * scale, step)
+    ]
+
+
+def truncate_tokens(text, max_tokens, model):
+    tokens, decode, scale = _tokenize(text, model)
+    size = max_tokens * scale
+    if len(tokens) <= size:
+        return text
+    return decode(tokens[:size])
+
+
+def is_long_submission(student_text, model):
+    return count_tokens(student_text, model) > MAX_STUDENT_TOKENS
+
+
+def cache_key(rubric_text, student_text, model, kind="grade"):
+    rubric_hash = hashlib.sha256(rubric_text.encode("utf-8")).hexdigest()[:16]
+    student_hash = hashlib.sha256(student_text.encode("utf-8")).hexdigest()[:16]
+    return f"{kind}-{rubric_hash}-{student_hash}-{model}"
+
+
+def get_cached(key):
+    path = JUDGE_CACHE_DIR / f"{key}.json"
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def put_cached(key, value):
+    JUDGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = JUDGE_CACHE_DIR / f"{key}.json"
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(value), encoding="utf-8")
+    tmp_path.replace(path)
+
+
+@contextlib.asynccontextmanager
+async def llm_call(**kwargs):
+    # Holds a concurrency slot for as long as the caller uses the response,
+    # so streams count against MAX_CONCURRENCY until they are fully read
+    delay = 1.0
+    for attempt in range(MAX_RETRIES):
+        async with _llm_semaphore:
+            try:
+                response = await client.responses.create(**kwargs)
+            except RETRYABLE_ERRORS:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+            else:
+                yield response
+                return
+        # Back off outside the semaphore so other requests can proceed
+        await asyncio.sleep(delay + random.uniform(0, delay))
+        delay *= 2
+
+
+async def create_response(**kwargs):
+    async with llm_call(**kwargs) as response:
+        return response
+
+
+# Document parsers are imported on first use so workers boot without them
+_lazy_modules = {}
+
+
+def lazy_import(name):
+    module = _lazy_modules.get(name)
+    if module is None:
+        module = importlib.import_module(name)
+        _lazy_modules[name] = module
+    return module
+
 
 def read_file_to_text(file_storage):
+    # Parsers read straight from the upload stream rather than a copy of it
     filename = (file_storage.filename or "").lower()
-    raw_bytes = file_storage.read()
-
-    def as_io():
-        return io.BytesIO(raw_bytes)
+    stream = file_storage.stream
 
     if filename.endswith((
         ".txt", ".py", ".java", ".cpp", ".c", ".md", ".html", ".json"
     )):
+        raw_bytes = stream.read()
         try:
             return raw_bytes.decode("utf-8", errors="ignore")
         except Exception:
             return raw_bytes.decode("latin-1", errors="ignore")
 
     elif filename.endswith(".csv"):
-        df = pd.read_csv(as_io())
-        return df.to_string(index=False)
+        text_stream = io.TextIOWrapper(
+            stream, encoding="utf-8", errors="replace", newline=""
+        )
+        try:
+            return "\n".join(",".join(row) for row in csv.reader(text_stream))
+        finally:
+            # Detach so closing the wrapper does not close the upload
+            text_stream.detach()
 
     elif filename.endswith(".xlsx"):
-        df = pd.read_excel(as_io())
-        return df.to_string(index=False)
+        openpyxl = lazy_import("openpyxl")
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            return "\n".join(
+                ",".join("" if value is None else str(value) for value in row)
+                for row in workbook.active.iter_rows(values_only=True)
+            )
+        finally:
+            workbook.close()
 
     elif filename.endswith(".docx"):
-        doc = Document(as_io())
+        doc = lazy_import("docx").Document(stream)
         return "\n".join(p.text for p in doc.paragraphs)
 
     elif filename.endswith(".pdf"):
-        reader = PdfReader(as_io())
+        try:
+            pdf = lazy_import("pypdfium2").PdfDocument(stream)
+            try:
+                pages = [
+                    pdf[i].get_textpage().get_text_range() for i in range(len(pdf))
+                ]
+            finally:
+                pdf.close()
+            return "\n".join(pages)
+        except Exception:
+            # PDFium rejected the file; fall back to the pure-Python reader
+            stream.seek(0)
+
+        reader = lazy_import("PyPDF2").PdfReader(stream)
         pages = []
         for page in reader.pages:
             try:
@@ -65,18 +273,54 @@ def read_file_to_text(file_storage):
         return "\n".join(pages)
 
     else:
+        raw_bytes = stream.read()
         try:
             return raw_bytes.decode("utf-8", errors="ignore")
         except Exception:
             return raw_bytes.decode("latin-1", errors="ignore")
 
 
-def parse_rubric_to_json(rubric_text, model="gpt-4.1-mini"):
+async def read_file_to_text_async(file_storage):
+    file_storage.stream.seek(0)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_file_executor, read_file_to_text, file_storage)
+
+
+# Structured output schema for parsed rubrics. Strict mode needs an object
+# at the top level, so the criteria list is wrapped in one.
+RUBRIC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "criteria": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "criterion": {"type": "string"},
+                    "description": {"type": "string"},
+                    "points": {"type": "integer"},
+                    "requirements": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["criterion", "description", "points", "requirements"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["criteria"],
+    "additionalProperties": False,
+}
+
+
+async def parse_rubric_to_json(rubric_text, model="gpt-4.1-mini"):
+    key = cache_key(rubric_text, "", model, kind="rubric")
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+
+    rubric_text = truncate_tokens(rubric_text, MAX_RUBRIC_TOKENS, model)
+
     system_prompt = (
         "You are an expert at transforming teacher rubrics into structured JSON. "
-        "You must ONLY return valid JSON with NO extra commentary. "
-        "Follow this schema strictly: a list of objects with keys: "
-        "'criterion', 'description', 'points', 'requirements'. "
         "If the rubric does not have explicit points, infer a reasonable point "
         "value for each."
     )
@@ -91,61 +335,43 @@ TASK:
    - "criterion": short title
    - "description": longer explanation (if available)
    - "points": integer points for this criterion
-   - "requirements": list of expectations
-4. Return ONLY a JSON array (no markdown, no backticks, no explanation)."""  # noqa: E501
+   - "requirements": list of expectations"""
 
-    response = client.responses.create(
+    response = await create_response(
         model=model,
         input=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ],
-    )
-
-    try:
-        raw_text = response.output[0].content[0].text
-        rubric_json = json.loads(raw_text)
-        if not isinstance(rubric_json, list):
-            rubric_json = [rubric_json]
-        return rubric_json
-    except Exception:
-        fallback = [
-            {
-                "criterion": "Overall Rubric",
-                "description": "Entire rubric treated as one criterion.",
-                "points": 100,
-                "requirements": [rubric_text.strip()[:1000]],
+        text={
+            "format": {
+                "type": "json_schema",
+                "name": "rubric",
+                "schema": RUBRIC_SCHEMA,
+                "strict": True,
             }
-        ]
-        return fallback
-
+        },
+    )
 
-def grade_with_rubric_json(rubric_json, student_text, model="gpt-4.1-mini"):
-    rubric_json_str = json.dumps(rubric_json, indent=2)
+    rubric_json = load_json(response.output_text)["criteria"]
 
-    system_prompt = (
-        "You are an encouraging, supportive computer science teacher who grades fairly "
-        "using a structured rubric. Your tone is positive, balanced, and growth-oriented. "
-        "You award partial credit with medium generosity when there is clear evidence of "
-        "partial understanding or effort. You still respect the rubric and do not give "
-        "full credit when requirements are missing, but you avoid harsh language. "
-        "You always highlight strengths first, then gently suggest improvements. "
-        "Write in clear paragraphs only. Do NOT use bullet points, dashes, asterisks, "
-        "or numbered lists. Do NOT use markdown formatting. "
-        "You must keep the student-facing summary separate from the teacher report."
-    )
+    put_cached(key, rubric_json)
+    return rubric_json
 
-    user_prompt = f"""RUBRIC (JSON)
-----------------
-{rubric_json_str}
 
-STUDENT SUBMISSION
-------------------
-{student_text}
+GRADER_SYSTEM_PROMPT = (
+    "You are an encouraging, supportive computer science teacher who grades fairly "
+    "using a structured rubric. Your tone is positive, balanced, and growth-oriented. "
+    "You award partial credit with medium generosity when there is clear evidence of "
+    "partial understanding or effort. You still respect the rubric and do not give "
+    "full credit when requirements are missing, but you avoid harsh language. "
+    "You always highlight strengths first, then gently suggest improvements. "
+    "Write in clear paragraphs only. Do NOT use bullet points, dashes, asterisks, "
+    "or numbered lists. Do NOT use markdown formatting. "
+    "You must keep the student-facing summary separate from the teacher report."
+)
 
-YOUR TASK
----------
-1. For EACH rubric item:
+GRADING_INSTRUCTIONS = """1. For EACH rubric item:
    Write a block in this exact structure:
 
    Criterion: <criterion name> (X points)
@@ -171,10 +397,180 @@ FORMAT RULES
 - Do not restate the score line inside the Student Summary.
 """  # noqa: E501
 
-    response = client.responses.create(
+
+def build_grading_prompt(rubric_json_str, student_text):
+    return f"""RUBRIC (JSON)
+----------------
+{rubric_json_str}
+
+STUDENT SUBMISSION
+------------------
+{student_text}
+
+YOUR TASK
+---------
+{GRADING_INSTRUCTIONS}"""
+
+
+def build_fused_prompt(rubric_text, student_text):
+    return f"""RUBRIC TEXT
+-----------
+{rubric_text}
+
+STUDENT SUBMISSION
+------------------
+{student_text}
+
+YOUR TASK
+---------
+0. Before writing anything, silently break the rubric into criteria, each with a short title, its expectations, and an integer point value (infer reasonable points if the rubric has none). Do not output this breakdown; use it to grade the submission below.
+
+{GRADING_INSTRUCTIONS}"""  # noqa: E501
+
+
+def build_reduce_prompt(rubric_json_str, window_notes):
+    notes = "\n\n".join(
+        f"PART {n} NOTES:\n{note}" for n, note in enumerate(window_notes, start=1)
+    )
+    return f"""RUBRIC (JSON)
+----------------
+{rubric_json_str}
+
+REVIEW NOTES ON A LONG STUDENT SUBMISSION
+-----------------------------------------
+The submission was too long to grade in one pass, so each part was reviewed separately. Parts overlap slightly, so the same evidence may appear twice; count it once.
+
+{notes}
+
+YOUR TASK
+---------
+Grade the submission as a whole, using the notes above as your evidence.
+
+{GRADING_INSTRUCTIONS}"""  # noqa: E501
+
+
+async def review_window(rubric_json_str, window_text, part, parts, model):
+    user_prompt = f"""RUBRIC (JSON)
+----------------
+{rubric_json_str}
+
+STUDENT SUBMISSION, PART {part} OF {parts}
+------------------------------------------
+{window_text}
+
+YOUR TASK
+---------
+For each rubric criterion, write a few plain sentences on the evidence in this part only: what the student did well and what is missing or incorrect. Do not assign scores and do not write a student summary."""  # noqa: E501
+
+    response = await create_response(
         model=model,
         input=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": GRADER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+    )
+
+    try:
+        return response.output[0].content[0].text
+    except Exception:
+        return str(response)
+
+
+def submission_windows(student_text, model):
+    # Returns the truncated submission and its review windows, or None for
+    # the windows when it is short enough to grade in one pass
+    student_text = truncate_tokens(student_text, MAX_SUBMISSION_TOKENS, model)
+    if not is_long_submission(student_text, model):
+        return student_text, None
+    windows = split_tokens(
+        student_text, WINDOW_TOKENS, model, overlap=WINDOW_OVERLAP_TOKENS
+    )
+    return student_text, windows
+
+
+async def iter_window_reviews(rubric_json_str, windows, model):
+    # Reviews all windows in parallel, yielding (part, notes) as each finishes
+    async def review(part, window):
+        return part, await review_window(
+            rubric_json_str, window, part, len(windows), model
+        )
+
+    tasks = [
+        asyncio.ensure_future(review(part, window))
+        for part, window in enumerate(windows, start=1)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def prepare_grading_prompt(rubric_json_str, student_text, model):
+    # Short submissions are graded directly. Long ones are reviewed window by
+    # window in parallel, and the final call grades from those notes.
+    student_text, windows = submission_windows(student_text, model)
+    if windows is None:
+        return build_grading_prompt(rubric_json_str, student_text)
+
+    window_notes = [None] * len(windows)
+    async for part, notes in iter_window_reviews(rubric_json_str, windows, model):
+        window_notes[part - 1] = notes
+    return build_reduce_prompt(rubric_json_str, window_notes)
+
+
+def prepare_fused_prompt(rubric_text, student_text, model):
+    rubric_text = truncate_tokens(rubric_text, MAX_RUBRIC_TOKENS, model)
+    return build_fused_prompt(rubric_text, student_text)
+
+
+async def grade_with_rubric_json(rubric_json, student_text, model="gpt-4.1-mini"):
+    rubric_json_str = dump_rubric_json(rubric_json)
+
+    key = cache_key(rubric_json_str, student_text, model, kind="grade")
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+
+    user_prompt = await prepare_grading_prompt(rubric_json_str, student_text, model)
+
+    response = await create_response(
+        model=model,
+        input=[
+            {"role": "system", "content": GRADER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+    )
+
+    try:
+        output_block = response.output[0].content[0].text
+    except Exception:
+        return str(response)
+
+    put_cached(key, output_block)
+    return output_block
+
+
+async def parse_and_grade(rubric_text, student_text, model="gpt-4.1-mini"):
+    # One round-trip: the model structures the raw rubric itself and grades
+    # against it, instead of a separate parse_rubric_to_json call first.
+    if is_long_submission(student_text, model):
+        # Windowed grading needs the structured rubric up front
+        rubric_json = await parse_rubric_to_json(rubric_text, model)
+        return await grade_with_rubric_json(rubric_json, student_text, model)
+
+    key = cache_key(rubric_text, student_text, model, kind="fused")
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+
+    user_prompt = prepare_fused_prompt(rubric_text, student_text, model)
+
+    response = await create_response(
+        model=model,
+        input=[
+            {"role": "system", "content": GRADER_SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
     )
@@ -182,121 +578,451 @@ FORMAT RULES
     try:
         output_block = response.output[0].content[0].text
     except Exception:
-        output_block = str(response)
+        return str(response)
 
+    put_cached(key, output_block)
     return output_block
 
 
+async def stream_grading(key, user_prompt, model="gpt-4.1-mini"):
+    # Yield the report as text deltas while the model writes it; cached
+    # reports are yielded whole.
+    cached = get_cached(key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    final_event = None
+    async with llm_call(
+        model=model,
+        input=[
+            {"role": "system", "content": GRADER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+        stream=True,
+    ) as stream:
+        async with stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    chunks.append(event.delta)
+                    yield event.delta
+                elif event.type in (
+                    "response.completed", "response.failed", "response.incomplete"
+                ):
+                    final_event = event.type
+
+    # A failed or cut-off response ends the stream without an exception;
+    # never cache it, or every replay would show an empty report
+    output_block = "".join(chunks)
+    if final_event != "response.completed" or not output_block.strip():
+        raise RuntimeError(
+            f"the grader stopped before finishing ({final_event or 'no response'})"
+        )
+
+    put_cached(key, output_block)
+
+
+_STUDENT_SENTINEL_RE = re.compile(r"===STUDENT_(\d+)===")
+
+
+async def request_batch_feedback(rubric_json_str, student_texts, model):
+    # One shared call for several submissions; returns the raw reply text
+    if not student_texts:
+        return ""
+
+    submissions = "\n\n".join(
+        f"Student {n}:\n{text}" for n, text in enumerate(student_texts, start=1)
+    )
+
+    user_prompt = f"""RUBRIC (JSON)
+----------------
+{rubric_json_str}
+
+STUDENT SUBMISSIONS
+-------------------
+{submissions}
+
+YOUR TASK
+---------
+Grade each of the {len(student_texts)} students independently. For each student N, start with a line containing only ===STUDENT_N=== and then follow the instructions below for that student alone.
+
+{GRADING_INSTRUCTIONS}"""  # noqa: E501
+
+    response = await create_response(
+        model=model,
+        input=[
+            {"role": "system", "content": GRADER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+    )
+
+    try:
+        return response.output[0].content[0].text
+    except Exception:
+        return str(response)
+
+
+async def grade_batch_with_rubric_json(rubric_json, student_texts, model="gpt-4.1-mini"):
+    # Row-marshal several submissions into one prompt so the rubric tokens and
+    # the round-trip are paid once per batch rather than once per student.
+    rubric_json_str = dump_rubric_json(rubric_json)
+
+    keys = [
+        cache_key(rubric_json_str, text, model, kind="grade") for text in student_texts
+    ]
+    results = [get_cached(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    # Long submissions would crowd the shared prompt; grade them on their own,
+    # concurrently with the shared call for the rest
+    long_pending = [i for i in pending if is_long_submission(student_texts[i], model)]
+    pending = [i for i in pending if i not in long_pending]
+
+    long_feedbacks, output_block = await asyncio.gather(
+        asyncio.gather(*[
+            grade_with_rubric_json(rubric_json, student_texts[i], model)
+            for i in long_pending
+        ]),
+        request_batch_feedback(
+            rubric_json_str, [student_texts[i] for i in pending], model
+        ),
+    )
+    for i, feedback in zip(long_pending, long_feedbacks):
+        results[i] = feedback
+
+    if not pending:
+        return results
+
+    # split() yields [preamble, "1", block1, "2", block2, ...]
+    parts = _STUDENT_SENTINEL_RE.split(output_block)
+    blocks = {int(n): block.strip() for n, block in zip(parts[1::2], parts[2::2])}
+
+    # A block only counts if it carries a score; refusals and cut-off blocks
+    # are treated like missing ones and never cached
+    missing = []
+    for n, i in enumerate(pending, start=1):
+        block = blocks.get(n)
+        if block and _SCORE_RE.search(block):
+            put_cached(keys[i], block)
+            results[i] = block
+        else:
+            missing.append(i)
+
+    # Unscored students are graded again on their own; if that still yields
+    # no scored report, fail loudly rather than show a default summary
+    if missing:
+        retried = await asyncio.gather(*[
+            grade_with_rubric_json(rubric_json, student_texts[i], model)
+            for i in missing
+        ])
+        for i, feedback in zip(missing, retried):
+            if not _SCORE_RE.search(feedback):
+                raise RuntimeError("the grader returned no feedback for a submission")
+            results[i] = feedback
+
+    return results
+
+
 def extract_scores(feedback_text):
-    pattern = r"Score:\s*(\d+)\s*/\s*(\d+)"
-    matches = re.findall(pattern, feedback_text)
     total_earned = 0
     total_possible = 0
-    for earned, possible in matches:
-        total_earned += int(earned)
-        total_possible += int(possible)
+    for match in _SCORE_RE.finditer(feedback_text):
+        total_earned += int(match[1])
+        total_possible += int(match[2])
     return total_earned, total_possible
 
 
-def extract_student_summary(feedback_text):
-    marker = "Student Summary:"
-    idx = feedback_text.find(marker)
-    if idx == -1:
-        return (
-            "You completed meaningful work and demonstrated growing skill. "
-            "Keep practicing and refining your logic, and use this feedback as a guide "
-            "for your next draft."
-        )
-    student_part = feedback_text[idx + len(marker):].strip()
-    return student_part
+class ScoreTally:
+    """Running score totals over feedback that arrives in pieces."""
+
+    def __init__(self):
+        self.text = ""
+        self.offset = 0
+        self.earned = 0
+        self.possible = 0
+
+    def _scan(self, end):
+        for match in _SCORE_RE.finditer(self.text, self.offset, end):
+            self.earned += int(match[1])
+            self.possible += int(match[2])
+        self.offset = end
+
+    def feed(self, delta):
+        self.text += delta
+        # Only scan complete lines so a half-written score is not counted
+        end = self.text.rfind("\n") + 1
+        if end > self.offset:
+            self._scan(end)
+
+    def finish(self):
+        self._scan(len(self.text))
+        return self.earned, self.possible
+
+
+DEFAULT_STUDENT_SUMMARY = (
+    "You completed meaningful work and demonstrated growing skill. "
+    "Keep practicing and refining your logic, and use this feedback as a guide "
+    "for your next draft."
+)
+
+
+def split_feedback(feedback_text):
+    # Returns (teacher report, student summary) from one scan for the marker
+    head, sep, tail = feedback_text.rpartition("Student Summary:")
+    if not sep:
+        return feedback_text.strip(), DEFAULT_STUDENT_SUMMARY
+    return head.strip(), tail.strip()
+
+
+def build_result(name, full_feedback, scores=None):
+    # Separate teacher report and student summary
+    earned, possible = scores or extract_scores(full_feedback)
+    if possible > 0:
+        percent = round((earned / possible) * 100)
+        score_line = f"Your Score: {earned} / {possible} ({percent}%)"
+    else:
+        score_line = "Your Score: N/A"
+
+    feedback, student_summary = split_feedback(full_feedback)
+
+    return {
+        "name": name,
+        "summary_text": f"{score_line}\n\n{student_summary}".strip(),
+        "feedback": feedback,
+    }
+
+
+async def grade_class_set(rubric_json, submissions):
+    # Identical submissions (shared starter code, copied answers) are graded
+    # once and their feedback is fanned back out to every student
+    unique_texts = {}
+    submission_hashes = []
+    for _, text in submissions:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        unique_texts.setdefault(text_hash, text)
+        submission_hashes.append(text_hash)
+
+    # Grade every batch of unique texts concurrently
+    texts = list(unique_texts.values())
+    batches = [
+        texts[start:start + BATCH_SIZE] for start in range(0, len(texts), BATCH_SIZE)
+    ]
+    batch_feedbacks = await asyncio.gather(*[
+        grade_batch_with_rubric_json(rubric_json, batch) for batch in batches
+    ])
+    feedbacks = [feedback for batch in batch_feedbacks for feedback in batch]
+    feedback_by_hash = dict(zip(unique_texts, feedbacks))
+
+    return [
+        build_result(name, feedback_by_hash[text_hash])
+        for (name, _), text_hash in zip(submissions, submission_hashes)
+    ]
+
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-def strip_student_summary(feedback_text):
-    marker = "Student Summary:"
-    idx = feedback_text.find(marker)
-    if idx == -1:
-        return feedback_text.strip()
-    return feedback_text[:idx].strip()
+
+async def read_grade_form():
+    # Returns the posted rubric text and a list of (display name, text)
+    # submissions; file parsing errors propagate to the caller.
+    form = await request.form
+    files = await request.files
+
+    rubric_text = (form.get("rubric_text") or "").strip()
+    student_text = (form.get("student_text") or "").strip()
+
+    rubric_file = files.get("rubric_file")
+    student_files = [f for f in files.getlist("student_file") if f.filename]
+
+    submissions = []
+    if student_text:
+        submissions.append(("Pasted submission", student_text))
+
+    # Parse the rubric and every student file concurrently in the file pool
+    has_rubric_file = bool(rubric_file and rubric_file.filename)
+    uploads = ([rubric_file] if has_rubric_file else []) + student_files
+    texts = await asyncio.gather(*[read_file_to_text_async(f) for f in uploads])
+
+    if has_rubric_file:
+        rubric_text = texts.pop(0)
+
+    for student_file, text in zip(student_files, texts):
+        submissions.append((student_file.filename, text))
+
+    return rubric_text, submissions
+
+
+def update_cached_rubric(rubric_text):
+    # Rubric caching: only update when teacher explicitly supplies a rubric
+    rubric_changed = bool(rubric_text) and (rubric_text != session.get("rubric_text"))
+    if rubric_changed:
+        session["rubric_text"] = rubric_text
+    return rubric_changed
+
+
+async def get_rubric_json(rubric_text):
+    # Reuse the parsed rubric from the session while the text it was parsed
+    # from is unchanged; otherwise parse it and remember both
+    rubric_hash = hashlib.sha256(rubric_text.encode("utf-8")).hexdigest()
+    if session.get("rubric_hash") == rubric_hash and "rubric_json" in session:
+        return session["rubric_json"]
+
+    rubric_json = await parse_rubric_to_json(rubric_text)
+    session["rubric_hash"] = rubric_hash
+    session["rubric_json"] = rubric_json
+    return rubric_json
 
 
 @app.route("/", methods=["GET", "POST"])
-def access_gate():
+async def access_gate():
     if request.method == "POST":
-        password = (request.form.get("password") or "").strip()
+        form = await request.form
+        password = (form.get("password") or "").strip()
         if password == ACCESS_PASSWORD:
             session["is_authenticated"] = True
             return redirect(url_for("grade"))
-    return render_template("login.html")
+    return await render_template("login.html")
 
 
 @app.route("/grade", methods=["GET", "POST"])
-def grade():
+async def grade():
     if not session.get("is_authenticated"):
         return redirect(url_for("access_gate"))
 
-    feedback = None
-    summary_text = None
+    results = []
     error = None
     rubric_loaded = bool(session.get("rubric_text"))
 
     if request.method == "POST":
-        rubric_text = (request.form.get("rubric_text") or "").strip()
-        student_text = (request.form.get("student_text") or "").strip()
-
-        rubric_file = request.files.get("rubric_file")
-        student_file = request.files.get("student_file")
-
         try:
-            if rubric_file and rubric_file.filename:
-                rubric_file.stream.seek(0)
-                rubric_text = read_file_to_text(rubric_file)
-
-            if student_file and student_file.filename:
-                student_file.stream.seek(0)
-                student_text = read_file_to_text(student_file)
+            rubric_text, submissions = await read_grade_form()
         except Exception as e:
             error = f"Error reading uploaded files: {e}"
 
         if not error:
-            # Rubric caching: only update when teacher explicitly supplies a rubric
-            if rubric_text:
-                session["rubric_text"] = rubric_text
-
+            rubric_changed = update_cached_rubric(rubric_text)
             rubric_text_cached = session.get("rubric_text", "")
 
             if not rubric_text_cached:
                 error = "Please provide a rubric (either text or file)."
-            elif not student_text:
+            elif not submissions:
                 error = "Please provide student work (either text or file)."
             else:
                 try:
-                    rubric_json = parse_rubric_to_json(rubric_text_cached)
-                    full_feedback = grade_with_rubric_json(rubric_json, student_text)
-
-                    # Separate teacher report and student summary
-                    earned, possible = extract_scores(full_feedback)
-                    if possible > 0:
-                        percent = round((earned / possible) * 100)
-                        score_line = f"Your Score: {earned} / {possible} ({percent}%)"
+                    if len(submissions) == 1 and rubric_changed:
+                        # New rubric: structure and grade in a single call
+                        name, text = submissions[0]
+                        full_feedback = await parse_and_grade(rubric_text_cached, text)
+                        results.append(build_result(name, full_feedback))
                     else:
-                        score_line = "Your Score: N/A"
+                        # Cached rubric or class set: parse once, reuse the JSON
+                        rubric_json = await get_rubric_json(rubric_text_cached)
 
-                    student_summary = extract_student_summary(full_feedback)
-                    summary_text = f"{score_line}\n\n{student_summary}".strip()
+                        if len(submissions) == 1:
+                            name, text = submissions[0]
+                            full_feedback = await grade_with_rubric_json(
+                                rubric_json, text
+                            )
+                            results.append(build_result(name, full_feedback))
+                        else:
+                            results = await grade_class_set(rubric_json, submissions)
 
-                    feedback = strip_student_summary(full_feedback)
                     rubric_loaded = True
                 except Exception as e:
                     error = f"Error during AI grading: {e}"
 
-    return render_template(
+    return await render_template(
         "index.html",
-        feedback=feedback,
-        summary_text=summary_text,
+        results=results,
         error=error,
         rubric_loaded=rubric_loaded,
     )
 
 
-if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000, debug=True)
+@app.route("/grade/stream", methods=["POST"])
+async def grade_stream():
+    # Server-sent events version of /grade for a single submission: the
+    # report is pushed to the browser as it is generated.
+    if not session.get("is_authenticated"):
+        return "Please log in again.", 401
+
+    try:
+        rubric_text, submissions = await read_grade_form()
+    except Exception as e:
+        return f"Error reading uploaded files: {e}", 400
+
+    rubric_changed = update_cached_rubric(rubric_text)
+    rubric_text_cached = session.get("rubric_text", "")
+
+    if not rubric_text_cached:
+        return "Please provide a rubric (either text or file).", 400
+    if not submissions:
+        return "Please provide student work (either text or file).", 400
+    if len(submissions) > 1:
+        return "Streaming grades one submission at a time.", 400
+
+    name, text = submissions[0]
+    model = "gpt-4.1-mini"
+
+    # Only the cached-rubric path sets these; generate() reads them either way
+    rubric_json_str = None
+    windows = None
+
+    try:
+        if rubric_changed and not is_long_submission(text, model):
+            key = cache_key(rubric_text_cached, text, model, kind="fused")
+            user_prompt = prepare_fused_prompt(rubric_text_cached, text, model)
+        else:
+            rubric_json = await get_rubric_json(rubric_text_cached)
+            rubric_json_str = dump_rubric_json(rubric_json)
+            key = cache_key(rubric_json_str, text, model, kind="grade")
+            # Cached reports are replayed without building a prompt. Long
+            # submissions are reviewed inside the stream so the browser gets
+            # progress events instead of waiting on the first byte.
+            user_prompt = None
+            if get_cached(key) is None:
+                student_text, windows = submission_windows(text, model)
+                if windows is None:
+                    user_prompt = build_grading_prompt(rubric_json_str, student_text)
+    except Exception as e:
+        return f"Error during AI grading: {e}", 502
+
+    async def generate():
+        tally = ScoreTally()
+        try:
+            prompt = user_prompt
+            if windows:
+                window_notes = [None] * len(windows)
+                yield sse_event("progress", {
+                    "message": f"Reviewing a long submission in {len(windows)} parts...",
+                })
+                reviewed = 0
+                async for part, notes in iter_window_reviews(
+                    rubric_json_str, windows, model
+                ):
+                    window_notes[part - 1] = notes
+                    reviewed += 1
+                    yield sse_event("progress", {
+                        "message": f"Reviewed part {reviewed}/{len(windows)}...",
+                    })
+                prompt = build_reduce_prompt(rubric_json_str, window_notes)
+
+            async for delta in stream_grading(key, prompt, model=model):
+                tally.feed(delta)
+                yield sse_event("delta", {
+                    "text": delta,
+                    "earned": tally.earned,
+                    "possible": tally.possible,
+                })
+            scores = tally.finish()
+            yield sse_event("done", build_result(name, tally.text, scores))
+        except Exception as e:
+            yield sse_event("error", {"message": f"Error during AI grading: {e}"})
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
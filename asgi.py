@@ -0,0 +1,2 @@
+# ASGI entry point for production; see Procfile.
+from app import app  # noqa: F401
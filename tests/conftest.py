@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# app.py refuses to import without a key; tests never reach the real API
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
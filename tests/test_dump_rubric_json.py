@@ -0,0 +1,21 @@
+import pytest
+
+import app as grader
+
+RUBRIC = [
+    {
+        "criterion": "Café ✓ 日本語",
+        "description": 'Handles "quotes", back\\slashes and\ttabs.',
+        "points": 10,
+        "requirements": [],
+    }
+]
+
+
+def test_fallback_matches_orjson(monkeypatch):
+    if grader.orjson is None:
+        pytest.skip("orjson is not installed")
+    with_orjson = grader.dump_rubric_json(RUBRIC)
+    monkeypatch.setattr(grader, "orjson", None)
+    # Grade cache keys hash this string, so both serializers must agree
+    assert grader.dump_rubric_json(RUBRIC) == with_orjson
@@ -0,0 +1,137 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from quart.sessions import SecureCookieSessionInterface
+
+import app as grader
+
+REPORT = (
+    "Criterion: Correctness (10 points)\n"
+    "Score: 7/10\n"
+    "Explanation:\n"
+    "The program runs and handles the main case.\n\n"
+    "Overall Teacher Comment:\n"
+    "Solid work with room to grow.\n\n"
+    "Student Summary:\n"
+    "Nice progress, keep testing edge cases."
+)
+
+RUBRIC = {
+    "criteria": [
+        {
+            "criterion": "Correctness",
+            "description": "Program works.",
+            "points": 10,
+            "requirements": ["Runs"],
+        }
+    ]
+}
+
+
+class FakeStream:
+    def __init__(self, text):
+        self.text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        yield SimpleNamespace(type="response.created")
+        for start in range(0, len(self.text), 16):
+            yield SimpleNamespace(
+                type="response.output_text.delta",
+                delta=self.text[start:start + 16],
+            )
+        yield SimpleNamespace(type="response.completed")
+
+
+class FakeResponses:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return FakeStream(REPORT)
+        if "text" in kwargs:
+            return SimpleNamespace(output_text=json.dumps(RUBRIC))
+        message = SimpleNamespace(content=[SimpleNamespace(text=REPORT)])
+        return SimpleNamespace(output=[message], output_text=REPORT)
+
+
+@pytest.fixture
+def responses(monkeypatch, tmp_path):
+    fake = FakeResponses()
+    monkeypatch.setattr(grader, "client", SimpleNamespace(responses=fake))
+    monkeypatch.setattr(grader, "JUDGE_CACHE_DIR", tmp_path / "judge_cache")
+    # Signed-cookie sessions so the tests do not need a Redis server
+    monkeypatch.setattr(
+        grader.app, "session_interface", SecureCookieSessionInterface()
+    )
+    return fake
+
+
+def parse_events(body):
+    events = []
+    for raw in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in raw.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+async def stream(test_client, form):
+    response = await test_client.post("/grade/stream", form=form)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    return parse_events(await response.get_data(as_text=True))
+
+
+def test_stream_new_rubric_uses_fused_call(responses):
+    async def run():
+        test_client = grader.app.test_client()
+        await test_client.post("/", form={"password": grader.ACCESS_PASSWORD})
+        return await stream(
+            test_client, {"rubric_text": "Works: 10 points", "student_text": "print(1)"}
+        )
+
+    events = asyncio.run(run())
+
+    names = [name for name, _ in events]
+    assert "error" not in names
+    assert names[-1] == "done"
+    assert "delta" in names
+
+    done = events[-1][1]
+    assert done["summary_text"].startswith("Your Score: 7 / 10 (70%)")
+    assert "Nice progress" in done["summary_text"]
+    assert "Student Summary" not in done["feedback"]
+
+    # One streamed call, no separate rubric parse
+    assert len(responses.calls) == 1
+    assert responses.calls[0]["stream"] is True
+
+
+def test_stream_cached_rubric_grades_against_parsed_json(responses):
+    async def run():
+        test_client = grader.app.test_client()
+        await test_client.post("/", form={"password": grader.ACCESS_PASSWORD})
+        await stream(
+            test_client, {"rubric_text": "Works: 10 points", "student_text": "print(1)"}
+        )
+        return await stream(test_client, {"student_text": "print(2)"})
+
+    events = asyncio.run(run())
+
+    assert [name for name, _ in events][-1] == "done"
+    assert events[-1][1]["summary_text"].startswith("Your Score: 7 / 10 (70%)")
+
+    # Fused call, then a structured rubric parse and a streamed grade
+    assert len(responses.calls) == 3
+    assert "text" in responses.calls[1]
+    assert responses.calls[2]["stream"] is True
+    assert "RUBRIC (JSON)" in responses.calls[2]["input"][-1]["content"]